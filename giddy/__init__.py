@@ -7,10 +7,30 @@ __version__ = "2.3.3"
 
 """
 
-from . import directional
-from . import ergodic
-from . import markov
-from . import mobility
-from . import rank
-from . import util
-from . import sequence
+import importlib
+import sys
+
+_SUBMODULES = [
+    "directional",
+    "ergodic",
+    "markov",
+    "mobility",
+    "rank",
+    "util",
+    "sequence",
+]
+
+if sys.version_info < (3, 7):
+    # module level __getattr__ (PEP 562) is not available
+    for _name in _SUBMODULES:
+        importlib.import_module("." + _name, __name__)
+else:
+    # submodules are imported on first access, so that importing giddy does
+    # not pull in the dependencies of every submodule
+    def __getattr__(name):
+        if name in _SUBMODULES:
+            return importlib.import_module("." + name, __name__)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    def __dir__():
+        return sorted(list(globals()) + _SUBMODULES)
@@ -0,0 +1,76 @@
+"""
+Numba kernels for the permutation inference of directional LISAs.
+
+Importing this module requires numba.
+"""
+
+__author__ = "Sergio J. Rey <sjsrey@gmail.com>"
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True, parallel=True)
+def _permutation_counts_numba(Y, indptr, indices, data, perm_idx, k):
+    """
+    Sector counts of the LISA vectors for a batch of random permutations.
+
+    Equivalent to :func:`giddy.directional._permutation_counts`, but the
+    spatial lag, angle and sector of every observation are computed in a
+    single pass over the rows of the weights, one permutation per thread.
+
+    Parameters
+    ----------
+    Y        : array
+               (n, 2), float64 variable observed on n spatial units over 2
+               time periods.
+    indptr   : array
+               CSR row pointers of the spatial weights.
+    indices  : array
+               CSR column indices of the spatial weights.
+    data     : array
+               CSR values of the spatial weights.
+    perm_idx : array
+               (permutations, n), each row is a permutation of range(n).
+    k        : int
+               Number of circular sectors.
+
+    Returns
+    -------
+    counts   : array
+               (permutations, k), sector counts for each permutation.
+
+    """
+
+    permutations, n = perm_idx.shape
+    inv_sw = k / (2 * np.pi)
+    counts = np.zeros((permutations, k), dtype=np.int64)
+    for m in prange(permutations):
+        idx = perm_idx[m]
+        for i in range(n):
+            wy0 = 0.0
+            wy1 = 0.0
+            for jj in range(indptr[i], indptr[i + 1]):
+                j = idx[indices[jj]]
+                wy0 += data[jj] * Y[j, 0]
+                wy1 += data[jj] * Y[j, 1]
+            yi = idx[i]
+            dx = Y[yi, 1] - Y[yi, 0]
+            dy = wy1 - wy0
+            if k == 4:
+                # the quadrant follows from the signs of dx and dy
+                if dy > 0.0:
+                    b = 1 if dx <= 0.0 else 0
+                elif dy < 0.0:
+                    b = 3 if dx >= 0.0 else 2
+                else:
+                    b = 2 if dx < 0.0 else 0
+            else:
+                theta = np.arctan2(dy, dx)
+                if theta < 0.0:
+                    theta += 2 * np.pi
+                b = int(theta * inv_sw)
+                if b > k - 1:
+                    b = k - 1
+            counts[m, b] += 1
+    return counts
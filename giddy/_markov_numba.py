@@ -0,0 +1,50 @@
+"""
+Numba kernels for counting Markov transitions.
+
+Importing this module requires numba.
+"""
+
+__author__ = "Sergio J. Rey <sjsrey@gmail.com>, Wei Kang <weikang9009@gmail.com>"
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _transition_counts_numba(ids, groups, k, m):
+    """
+    Count the transitions between classes in consecutive periods.
+
+    Equivalent to :func:`giddy.markov._transition_counts`, but the counts
+    are accumulated in a single pass over the panel without building the
+    (n, t-1) array of packed transition keys.
+
+    Parameters
+    ----------
+    ids       : array
+                (n, t), integer coded classes (0, ..., k-1) of n observations
+                over t periods.
+    groups    : array or None
+                (n, t-1), integer coded groups (0, ..., m-1) the transitions
+                are conditioned on. If None all transitions are counted in a
+                single group.
+    k         : int
+                number of classes.
+    m         : int
+                number of groups.
+
+    Returns
+    -------
+    transitions : array
+                  (m, k, k), count of transitions from each class (rows) to
+                  each class (columns) in each group.
+
+    """
+
+    n, t = ids.shape
+    transitions = np.zeros((m, k, k))
+    for i in range(n):
+        for j in range(t - 1):
+            g = 0 if groups is None else groups[i, j]
+            transitions[g, ids[i, j], ids[i, j + 1]] += 1
+    return transitions
@@ -6,15 +6,180 @@ __author__ = "Sergio J. Rey <sjsrey@gmail.com>"
 
 __all__ = ["Rose"]
 
+import operator
 import warnings
 import numpy as np
-from libpysal import weights
 from libpysal.common import requires as _requires
 
+# sector masks for the directional alternatives, kept for backwards
+# compatibility; Rose builds the masks for any k that is a multiple of 4
 _POS8 = np.array([1, 1, 0, 0, 1, 1, 0, 0])
 _POS4 = np.array([1, 0, 1, 0])
 _NEG8 = 1 - _POS8
 _NEG4 = 1 - _POS4
+# below this many observations the weights are lagged as a dense matrix
+_DENSE_MAX_N = 100
+# normal critical value of the 99% interval used by sequential permutations
+_SEQUENTIAL_Z = 2.576
+# permutation batches of at least this many observations (n * permutations)
+# are counted by the numba kernel when numba is installed, smaller ones do
+# not make up for the cost of compiling or loading it
+_NUMBA_MIN_SIZE = 2**22
+
+
+def _random_permutations(rng, permutations, n):
+    """
+    Draw random permutations of n observations.
+
+    Parameters
+    ----------
+    rng          : numpy.random.Generator
+                   Random number generator.
+    permutations : int
+                   Number of permutations.
+    n            : int
+                   Number of observations.
+
+    Returns
+    -------
+    perm_idx     : array
+                   (permutations, n), each row is a permutation of range(n).
+
+    """
+
+    # Generator.permuted needs numpy>=1.20, which is not available on
+    # python 3.6; sorting uniform keys gives uniform random permutations too
+    return np.argsort(rng.random((permutations, n)), axis=1)
+
+
+def _quadrant(dx, dy):
+    """
+    Quadrant of LISA vectors from the signs of their components.
+
+    Same as bucketing the wrapped angle ``arctan2(dy, dx)`` into 4 sectors,
+    including vectors on the axes, without evaluating the arctangent.
+
+    Parameters
+    ----------
+    dx : array
+         Movement of the focal units.
+    dy : array
+         Movement of their spatial lags.
+
+    Returns
+    -------
+       : array
+         Sector of each vector, 0 to 3 counterclockwise from the positive
+         x axis.
+
+    """
+
+    return np.where(dy > 0, dx <= 0, np.where(dy < 0, 2 + (dx >= 0), 2 * (dx < 0)))
+
+
+def _sectors(dx, dy, k):
+    """
+    Circular sector of LISA vectors.
+
+    Parameters
+    ----------
+    dx : array
+         Movement of the focal units.
+    dy : array
+         Movement of their spatial lags.
+    k  : int
+         Number of circular sectors.
+
+    Returns
+    -------
+       : array
+         Sector of each vector, 0 to k-1 counterclockwise from the positive
+         x axis.
+
+    """
+
+    if k == 4:
+        return _quadrant(dx, dy)
+    # sectors are equally spaced, so the sector is floor(theta / sw)
+    theta = np.arctan2(dy, dx)
+    np.add(theta, 2 * np.pi, out=theta, where=theta < 0)
+    theta *= k / (2 * np.pi)
+    bins = theta.astype(np.intp)
+    np.minimum(bins, k - 1, out=bins)
+    return bins
+
+
+def _permutation_counts(Y, W, k, perm_idx, spmm=operator.matmul):
+    """
+    Sector counts of the LISA vectors for a batch of random permutations.
+
+    Parameters
+    ----------
+    Y        : array
+               (n, 2), variable observed on n spatial units over 2 time
+               periods.
+    W        : array or sparse matrix
+               (n, n), spatial weights.
+    k        : int
+               Number of circular sectors.
+    perm_idx : array
+               (permutations, n), each row is a permutation of range(n).
+    spmm     : callable, optional
+               Function multiplying W with a dense matrix. Default is the
+               @ operator.
+
+    Returns
+    -------
+    counts   : array
+               (permutations, k), sector counts for each permutation.
+
+    """
+
+    n = Y.shape[0]
+    permutations = perm_idx.shape[0]
+    # (n, permutations, 2) stack of permuted copies, lagged in one SpMM
+    Yp = Y[perm_idx.T]
+    wYp = spmm(W, Yp.reshape(n, -1)).reshape(Yp.shape)
+    dx = Yp[:, :, -1] - Yp[:, :, 0]
+    dy = wYp[:, :, -1] - wYp[:, :, 0]
+    bins = _sectors(dx, dy, k)
+    # offset the sectors of each permutation so one bincount tallies all
+    bins += np.arange(permutations) * k
+    counts = np.bincount(bins.ravel(), minlength=permutations * k)
+    return counts.reshape(permutations, k)
+
+
+def _perm_batch(Y, W, k, seed, permutations, spmm=operator.matmul):
+    """
+    Sector counts for a batch of permutations drawn from its own generator.
+
+    Parameters
+    ----------
+    Y            : array
+                   (n, 2), variable observed on n spatial units over 2 time
+                   periods.
+    W            : array or sparse matrix
+                   (n, n), spatial weights.
+    k            : int
+                   Number of circular sectors.
+    seed         : {None, int, SeedSequence}
+                   Seed of the random generator for this batch.
+    permutations : int
+                   Number of permutations in the batch.
+    spmm         : callable, optional
+                   Function multiplying W with a dense matrix. Default is the
+                   @ operator.
+
+    Returns
+    -------
+    counts       : array
+                   (permutations, k), sector counts for each permutation.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    perm_idx = _random_permutations(rng, permutations, Y.shape[0])
+    return _permutation_counts(Y, W, k, perm_idx, spmm)
 
 
 class Rose(object):
@@ -32,10 +197,16 @@ class Rose(object):
         Spatial weights object.
     k : int
         Number of circular sectors in rose diagram.
+    permutations : int
+        Number of random permutations to run on construction, see `permute`.
+    alternative : string
+        Alternative hypothesis for the permutations run on construction.
+    seed : {None, int, numpy.random.Generator}
+        Seed for the permutations run on construction.
 
     Attributes
     ----------
-    cuts : (k, 1) ndarray
+    cuts : (k+1, ) ndarray
         Radian cuts for rose diagram (circular histogram).
     counts: (k, 1) ndarray
         Number of vectors contained in each sector.
@@ -44,7 +215,8 @@ class Rose(object):
     theta : (n,1) ndarray
         Signed radians for observed LISA vectors.
 
-    If self.permute is called the following attributes are available:
+    If permutations > 0 or self.permute is called the following attributes
+    are available:
 
     alternative : string
         Form of the specified alternative hypothesis ['two-sided'(default) |
@@ -62,7 +234,7 @@ class Rose(object):
 
     """
 
-    def __init__(self, Y, w, k=8):
+    def __init__(self, Y, w, k=8, permutations=0, alternative="two.sided", seed=None):
         """
         Calculation of rose diagram for local indicators of spatial
         association.
@@ -75,7 +247,14 @@ class Rose(object):
             Spatial weights object.
         k : int
             number of circular sectors in rose diagram (the default is 8).
-
+        permutations : int, optional
+            Number of random permutations used for inference. If 0 (default)
+            no permutations are run; `permute` can be called later instead.
+        alternative : string, optional
+            Type of alternative for the permutations, see `permute`.
+            Default is 'two.sided'.
+        seed : {None, int, numpy.random.Generator}, optional
+            Seed for the random permutations, see `permute`.
 
         Notes
         -----
@@ -175,7 +354,7 @@ class Rose(object):
         >>> r8 = Rose(Y, w, k=8)
         >>> r8.permute()
         >>> r8.p
-        array([0.86, 0.08, 0.16, 0.  , 0.02, 0.2 , 0.56, 0.  ])
+        array([0.96, 0.06, 0.16, 0.  , 0.04, 0.18, 0.56, 0.02])
 
         The default is a two-sided alternative. There is an option for a
         directional alternative reflecting positive co-movement of the focal
@@ -186,14 +365,22 @@ class Rose(object):
 
         >>> r8.permute(alternative='positive')
         >>> r8.p
-        array([0.51, 0.04, 0.28, 0.02, 0.01, 0.14, 0.57, 0.03])
+        array([0.46, 0.06, 0.24, 0.02, 0.01, 0.06, 0.66, 0.01])
 
         Finally, there is a second directional alternative for examining the
         hypothesis that the focal unit and its lag move in opposite directions.
 
         >>> r8.permute(alternative='negative')
         >>> r8.p
-        array([0.69, 0.99, 0.92, 1.  , 1.  , 0.97, 0.74, 1.  ])
+        array([0.72, 0.99, 0.91, 1.  , 1.  , 0.98, 0.76, 1.  ])
+
+        Permuting does not alter the observed LISA vectors, which the plots
+        below are based on
+
+        >>> lag = r8.wY.copy()
+        >>> r8.permute()
+        >>> np.array_equal(lag, r8.wY)
+        True
 
         We can call the plot method to visualize directional LISAs as a
         rose diagram conditional on the starting relative income:
@@ -206,24 +393,63 @@ class Rose(object):
         self.w = w
         self.k = k
         self.sw = 2 * np.pi / self.k
-        self.cuts = np.arange(0.0, 2 * np.pi + self.sw, self.sw)
-        observed = self._calc(Y, w, k)
+        self.cuts = np.linspace(0, 2 * np.pi, self.k + 1)
+        if self.k % 4 == 0:
+            # sectors in quadrants I and III (NE, SW) indicate co-movement
+            quadrant = np.arange(self.k) * 4 // self.k
+            self._pos_mask = (quadrant % 2 == 0).astype(np.int8)
+            self._neg_mask = 1 - self._pos_mask
+        else:
+            self._pos_mask = self._neg_mask = None
+        self._W = w.sparse.tocsr().astype(np.float64)
+        if self._W.shape[0] <= _DENSE_MAX_N:
+            self._W_lag = self._W.toarray()
+        else:
+            self._W_lag = self._W
+        # the permutation distribution is computed in single precision,
+        # which is plenty to assign angles to sectors
+        self._W_perm = self._W_lag.astype(np.float32)
+        self._Y_perm = np.asarray(Y, dtype=np.float32)
+        self._spmm = operator.matmul
+        if not isinstance(self._W_perm, np.ndarray):
+            # MKL's sparse-dense product is multithreaded over the wide stack
+            # of permuted copies
+            try:
+                from sparse_dot_mkl import dot_product_mkl
+            except ImportError:
+                pass
+            else:
+                self._spmm = dot_product_mkl
+        observed = self._calc(Y, k)
         self.theta = observed["theta"]
         self.bins = observed["bins"]
         self.counts = observed["counts"]
         self.r = observed["r"]
         self.lag = observed["lag"]
+        self.wY = self.lag
         self._dx = observed["dx"]
         self._dy = observed["dy"]
-
-    def permute(self, permutations=99, alternative="two.sided"):
+        if permutations:
+            self.permute(permutations, alternative=alternative, seed=seed)
+
+    def permute(
+        self,
+        permutations=99,
+        alternative="two.sided",
+        n_jobs=1,
+        seed=None,
+        sequential=False,
+        alpha=0.05,
+        batch=50,
+    ):
         """
         Generate ransom spatial permutations for inference on LISA vectors.
 
         Parameters
         ----------
         permutations : int, optional
-            Number of random permutations of observations.
+            Number of random permutations of observations. With
+            sequential=True this is the maximum number of permutations.
         alternative : string, optional
             Type of alternative to form in generating p-values.
             Options are: `two-sided` which tests for difference between observed
@@ -231,25 +457,182 @@ class Rose(object):
             `positive` which tests the alternative that the focal unit and its
             lag move in the same direction over time; `negative` which tests
             that the focal unit and its lag move in opposite directions over
-            the interval.
+            the interval. The directional alternatives require k to be a
+            multiple of 4.
+        n_jobs : int, optional
+            Number of parallel jobs the permutations are split across.
+            -1 uses all available cores. Requires numba or joblib when
+            not 1.
+            Default is 1.
+        seed : {None, int, numpy.random.Generator}, optional
+            Seed for the random permutations. If None (default) the
+            generator is seeded from numpy's global random state, so
+            ``np.random.seed`` makes the results reproducible.
+        sequential : bool, optional
+            If True, run the permutations in batches and stop as soon as the
+            p-value of every sector is clearly above or below alpha.
+            Default is False.
+        alpha : float, optional
+            Significance level the sequential stopping rule tests against.
+            Default is 0.05.
+        batch : int, optional
+            Number of permutations per batch when sequential=True.
+            Default is 50.
+
+        Notes
+        -----
+        With n_jobs=1 large batches of permutations are run through a
+        compiled kernel when numba is installed, and through vectorized numpy
+        otherwise. With n_jobs != 1 the compiled kernel runs the permutations
+        on n_jobs threads, and without numba they are split across n_jobs
+        joblib worker processes.
+        The numpy path works in single precision, so for the same random
+        state the two can only differ for vectors lying on a sector edge.
+
+        The sequential rule stops updating the p-value of a sector once alpha
+        lies outside a 99% Wilson confidence interval of it, and stops
+        permuting once every sector is decided. The p-value, `larger_perm`
+        and `smaller_perm` of a sector only count the permutations run until
+        it was decided, while `counts_perm` keeps the counts of every
+        permutation actually run.
         """
-        rY = self.Y.copy()
-        idxs = np.arange(len(rY))
-        counts = np.zeros((permutations, len(self.counts)))
-        for m in range(permutations):
-            np.random.shuffle(idxs)
-            res = self._calc(rY[idxs, :], self.w, self.k)
-            counts[m] = res["counts"]
+        if alternative.upper() in ("POSITIVE", "NEGATIVE") and self._pos_mask is None:
+            raise ValueError(
+                "The %s alternative requires the number of sectors k to be a "
+                "multiple of 4, got k=%d." % (alternative, self.k)
+            )
+        if seed is None:
+            seed = np.random.randint(np.iinfo(np.int32).max)
+        rng = np.random.default_rng(seed)
+        if not sequential:
+            counts = self._draw_counts(permutations, n_jobs, rng)
+            larger = (counts >= self.counts).sum(axis=0)
+            smaller = (counts <= self.counts).sum(axis=0)
+            n_perm = permutations
+        else:
+            counts = np.empty((permutations, self.k), dtype=np.int64)
+            larger = np.zeros(self.k, dtype=np.int64)
+            smaller = np.zeros(self.k, dtype=np.int64)
+            n_perm = np.zeros(self.k, dtype=np.int64)
+            active = np.ones(self.k, dtype=bool)
+            done = 0
+            while done < permutations and active.any():
+                size = min(batch, permutations - done)
+                batch_counts = self._draw_counts(size, n_jobs, rng)
+                counts[done : done + size] = batch_counts
+                batch_counts = batch_counts[:, active]
+                larger[active] += (batch_counts >= self.counts[active]).sum(axis=0)
+                smaller[active] += (batch_counts <= self.counts[active]).sum(axis=0)
+                n_perm[active] += size
+                done += size
+                p = self._p_values(larger, smaller, n_perm, alternative)
+                if p is None:
+                    continue
+                # Wilson score interval of the Monte Carlo p-values, which
+                # unlike the normal interval does not vanish at p = 0
+                z2 = _SEQUENTIAL_Z**2 / done
+                center = (p + z2 / 2) / (1 + z2)
+                spread = np.sqrt(p * (1 - p) / done + z2 / (4 * done))
+                halfwidth = _SEQUENTIAL_Z / (1 + z2) * spread
+                active &= np.abs(center - alpha) <= halfwidth
+            counts = counts[:done]
         self.counts_perm = counts
-        self.larger_perm = np.array(
-            [(counts[:, i] >= self.counts[i]).sum() for i in range(self.k)]
-        )
-        self.smaller_perm = np.array(
-            [(counts[:, i] <= self.counts[i]).sum() for i in range(self.k)]
-        )
+        self.larger_perm = larger
+        self.smaller_perm = smaller
+        p = self._p_values(larger, smaller, n_perm, alternative)
         self.expected_perm = counts.mean(axis=0)
         self.alternative = alternative
+        if p is None:
+            print(("Bad option for alternative: %s." % alternative))
+        else:
+            self.p = p
 
+    def _draw_counts(self, permutations, n_jobs, rng):
+        """
+        Sector counts for a number of random permutations.
+
+        Parameters
+        ----------
+        permutations : int
+            Number of random permutations of observations.
+        n_jobs : int
+            Number of parallel jobs the permutations are split across.
+        rng : numpy.random.Generator
+            Random number generator the permutations are drawn from.
+
+        Returns
+        -------
+        counts : (permutations, k) ndarray
+            Sector counts for each permutation.
+        """
+        n = self.Y.shape[0]
+        if n_jobs != 1 or n * permutations >= _NUMBA_MIN_SIZE:
+            try:
+                import numba
+                from ._directional_numba import _permutation_counts_numba
+            except ImportError:
+                pass
+            else:
+                # the kernel runs the permutations on n_jobs threads itself
+                threads = numba.get_num_threads()
+                if n_jobs > 0:
+                    numba.set_num_threads(min(n_jobs, threads))
+                try:
+                    return _permutation_counts_numba(
+                        np.ascontiguousarray(self.Y, dtype=np.float64),
+                        self._W.indptr,
+                        self._W.indices,
+                        self._W.data,
+                        _random_permutations(rng, permutations, n),
+                        self.k,
+                    )
+                finally:
+                    numba.set_num_threads(threads)
+        if n_jobs == 1:
+            perm_idx = _random_permutations(rng, permutations, n)
+            return _permutation_counts(
+                self._Y_perm, self._W_perm, self.k, perm_idx, self._spmm
+            )
+        try:
+            from joblib import Parallel, delayed, effective_n_jobs
+        except ImportError:
+            raise ImportError(
+                "joblib or numba is required to run permutations with n_jobs != 1"
+            )
+        n_jobs = effective_n_jobs(n_jobs)
+        sizes = [len(b) for b in np.array_split(range(permutations), n_jobs)]
+        entropy = rng.integers(np.iinfo(np.int64).max)
+        seeds = np.random.SeedSequence(entropy).spawn(n_jobs)
+        # the batches run in worker processes, on threads they are no faster
+        # than a single job
+        batches = Parallel(n_jobs=n_jobs)(
+            delayed(_perm_batch)(
+                self._Y_perm, self._W_perm, self.k, seed, size, self._spmm
+            )
+            for seed, size in zip(seeds, sizes)
+        )
+        return np.vstack(batches)
+
+    def _p_values(self, larger, smaller, permutations, alternative):
+        """
+        Pseudo p-values of the observed sector counts.
+
+        Parameters
+        ----------
+        larger : (k, ) ndarray
+            Number of times realized counts are as large as observed.
+        smaller : (k, ) ndarray
+            Number of times realized counts are as small as observed.
+        permutations : int or (k, ) ndarray
+            Number of permutations the counts are taken over.
+        alternative : string
+            Type of alternative, see `permute`.
+
+        Returns
+        -------
+        p : (k, ) ndarray
+            Pseudo p-values, None if the alternative is not recognized.
+        """
         # pvalue logic
         # if P is the proportion that are as large for a one sided test (larger
         # than), then
@@ -269,45 +652,36 @@ class Rose(object):
 
         alt = alternative.upper()
         if alt == "TWO.SIDED":
-            P = (self.larger_perm + 1) / (permutations + 1.0)
+            P = (larger + 1) / (permutations + 1.0)
             mask = P < 0.5
-            self.p = mask * 2 * P + (1 - mask) * 2 * (1 - P)
+            p = mask * 2 * P + (1 - mask) * 2 * (1 - P)
         elif alt == "POSITIVE":
             # NE, SW sectors are higher, NW, SE are lower
-            POS = _POS8
-            if self.k == 4:
-                POS = _POS4
-            L = (self.larger_perm + 1) / (permutations + 1.0)
-            S = (self.smaller_perm + 1) / (permutations + 1.0)
-            P = POS * L + (1 - POS) * S
-            self.p = P
+            POS = self._pos_mask
+            L = (larger + 1) / (permutations + 1.0)
+            S = (smaller + 1) / (permutations + 1.0)
+            p = POS * L + (1 - POS) * S
         elif alt == "NEGATIVE":
             # NE, SW sectors are lower, NW, SE are higher
-            NEG = _NEG8
-            if self.k == 4:
-                NEG = _NEG4
-            L = (self.larger_perm + 1) / (permutations + 1.0)
-            S = (self.smaller_perm + 1) / (permutations + 1.0)
-            P = NEG * L + (1 - NEG) * S
-            self.p = P
+            NEG = self._neg_mask
+            L = (larger + 1) / (permutations + 1.0)
+            S = (smaller + 1) / (permutations + 1.0)
+            p = NEG * L + (1 - NEG) * S
         else:
-            print(("Bad option for alternative: %s." % alternative))
+            p = None
+        return p
 
-    def _calc(self, Y, w, k):
-        wY = weights.lag_spatial(w, Y)
+    def _calc(self, Y, k):
+        wY = self._W_lag @ Y
         dx = Y[:, -1] - Y[:, 0]
         dy = wY[:, -1] - wY[:, 0]
-        self.wY = wY
-        self.Y = Y
-        r = np.sqrt(dx * dx + dy * dy)
+        r = np.hypot(dx, dy)
         theta = np.arctan2(dy, dx)
-        neg = theta < 0.0
-        utheta = theta * (1 - neg) + neg * (2 * np.pi + theta)
-        counts, bins = np.histogram(utheta, self.cuts)
+        counts = np.bincount(_sectors(dx, dy, k), minlength=k)
         results = {}
         results["counts"] = counts
         results["theta"] = theta
-        results["bins"] = bins
+        results["bins"] = self.cuts
         results["r"] = r
         results["lag"] = wY
         results["dx"] = dx
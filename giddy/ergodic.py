@@ -1,15 +1,76 @@
 """
 Summary measures for ergodic Markov chains.
 """
+
 __author__ = "Sergio J. Rey <sjsrey@gmail.com>, Wei Kang <weikang9009@gmail.com>"
 
 __all__ = ["steady_state", "var_fmpt_ergodic", "fmpt"]
 
+import functools
 import numpy as np
 import numpy.linalg as la
-import quantecon as qe
+from scipy import sparse
+from scipy.sparse import csgraph
 from .util import fill_empty_diagonals
 
+# transition matrices up to this size have their classes cached
+_CLASSES_CACHE_MAX_BYTES = 2**20
+# chains with transition probabilities below this may be nearly reducible,
+# and their steady states are found with the slower but stable GTH algorithm
+_GTH_MIN_P = 1e-8
+# memory budget for solving the linear systems of a non-ergodic fmpt at once
+_FMPT_BATCH_BYTES = 2**23
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_communication_classes(P_bytes, shape):
+    P = np.frombuffer(P_bytes).reshape(shape)
+    return _find_communication_classes(P)
+
+
+def _find_communication_classes(P):
+    graph = sparse.csr_matrix(P)
+    num_classes, labels = csgraph.connected_components(graph, connection="strong")
+    order = np.argsort(labels, kind="stable")
+    classes = np.split(order, np.cumsum(np.bincount(labels))[:-1])
+    # a class is recurrent if no transition leaves it
+    rows, cols = graph.nonzero()
+    leaves = labels[rows] != labels[cols]
+    transient = np.zeros(num_classes, dtype=bool)
+    transient[labels[rows[leaves]]] = True
+    recurrent = [classes[c] for c in np.flatnonzero(~transient)]
+    return classes, recurrent
+
+
+def _communication_classes(P):
+    """
+    Communication classes of a Markov chain, found as the strongly
+    connected components of its transition graph.
+
+    Results are cached on the contents of small matrices, so the classes
+    are only searched for once when e.g. both `steady_state` and `fmpt` are
+    called on the same matrix. The cached arrays are shared, so they must
+    not be modified in place.
+
+    Parameters
+    ----------
+    P           : array
+                  (k, k), a Markov transition probability matrix.
+
+    Returns
+    -------
+    classes     : list
+                  Sorted state indices of each communication class.
+    recurrent   : list
+                  Sorted state indices of each recurrent class.
+
+    """
+
+    P = np.ascontiguousarray(P, dtype=np.float64)
+    if P.nbytes > _CLASSES_CACHE_MAX_BYTES:
+        return _find_communication_classes(P)
+    return _cached_communication_classes(P.tobytes(), P.shape)
+
 
 def _steady_state_ergodic(P):
     """
@@ -47,18 +108,98 @@ def _steady_state_ergodic(P):
 
     """
 
-    v, d = la.eig(np.transpose(P))
-    d = np.array(d)
+    P = np.asarray(P)
+    k = P.shape[0]
+    if (P == P[0]).all():
+        # the chain forgets its state after one step
+        return P[0] / P[0].sum()
+    if ((P > 0) & (P < _GTH_MIN_P)).any():
+        # rare transitions may be all that couples parts of the chain, which
+        # makes the LU solve below lose most of its digits
+        return _gth_solve(P)
+    # solve pi (I - P) = 0 for the left eigenvector of eigenvalue 1, with
+    # the last (redundant) equation replaced by the constraint sum(pi) = 1
+    A = np.identity(k) - P.T
+    A[-1] = 1
+    b = np.zeros(k)
+    b[-1] = 1
+    return la.solve(A, b)
+
+
+def _gth_solve(P):
+    """
+    Steady state distribution of an ergodic Markov transition matrix P by
+    the Grassmann-Taksar-Heyman (GTH) algorithm.
 
-    # for a regular P maximum eigenvalue will be 1
-    mv = max(v)
-    # find its position
-    i = v.tolist().index(mv)
+    GTH elimination involves no subtractions, so unlike a LU solve it stays
+    accurate for nearly reducible chains.
 
-    row = abs(d[:, i])
+    Parameters
+    ----------
+    P        : array
+               (k, k), an ergodic Markov transition probability matrix.
 
-    # normalize eigenvector corresponding to the eigenvalue 1
-    return row / sum(row)
+    Returns
+    -------
+             : array
+               (k, ), steady state distribution.
+
+    """
+
+    A = np.array(P, dtype=np.float64)
+    k = A.shape[0]
+    for i in range(k - 1):
+        # fold state i into the states after it
+        scale = A[i, i + 1 : k].sum()
+        if scale <= 0:
+            # the states up to i form a closed class
+            k = i + 1
+            break
+        A[i + 1 : k, i] /= scale
+        A[i + 1 : k, i + 1 : k] += np.outer(A[i + 1 : k, i], A[i, i + 1 : k])
+    x = np.zeros(A.shape[0])
+    x[k - 1] = 1
+    for i in range(k - 2, -1, -1):
+        x[i] = x[i + 1 : k] @ A[i + 1 : k, i]
+    return x / x.sum()
+
+
+def _fill_empty_classes(P, fill_empty_classes):
+    """
+    Check a transition probability matrix for rows full of 0s.
+
+    Parameters
+    ----------
+    P                 : array
+                        (k, k), a Markov transition probability matrix, or
+                        (m, k, k), a stack of m of them.
+    fill_empty_classes: bool
+                        If True, assign 1 to the diagonal elements of rows
+                        full of 0s, otherwise raise a ValueError if there are
+                        any.
+
+    Returns
+    -------
+    P                 : array
+                        P itself if it has no rows full of 0s, or a filled
+                        copy.
+
+    """
+
+    row_sums = P.sum(axis=-1)
+    if row_sums.all():
+        return P
+    if not fill_empty_classes:
+        raise ValueError(
+            "Input transition probability matrix has "
+            "%d rows full of 0s. Please set "
+            "fill_empty_classes=True to set diagonal "
+            "elements for these rows to be 1 to make "
+            "sure the matrix is stochastic." % (row_sums == 0).sum()
+        )
+    if P.ndim == 2:
+        return fill_empty_diagonals(P, np.flatnonzero(row_sums == 0))
+    return fill_empty_diagonals(P)
 
 
 def steady_state(P, fill_empty_classes=False):
@@ -122,25 +263,21 @@ def steady_state(P, fill_empty_classes=False):
 
     """
 
-    P = np.asarray(P)
-    rows0 = (P.sum(axis=1) == 0).sum()
-    if rows0 > 0:
-        if fill_empty_classes:
-            P = fill_empty_diagonals(P)
-        else:
-            raise ValueError(
-                "Input transition probability matrix has "
-                "%d rows full of 0s. Please set "
-                "fill_empty_classes=True to set diagonal "
-                "elements for these rows to be 1 to make "
-                "sure the matrix is stochastic." % rows0
-            )
-    mc = qe.MarkovChain(P)
-    num_classes = mc.num_communication_classes
-    if num_classes == 1:
-        return mc.stationary_distributions[0]
+    P = np.ascontiguousarray(P, dtype=np.float64)
+    P = _fill_empty_classes(P, fill_empty_classes)
+    k = P.shape[0]
+    if k > 1 and (np.diag(P) == 1).all():
+        # every state is absorbing and its own recurrent class
+        return np.identity(k)
+    classes, recurrent = _communication_classes(P)
+    if len(classes) == 1:
+        return _steady_state_ergodic(P)
     else:
-        return mc.stationary_distributions
+        # one distribution per recurrent class, supported on that class
+        ss = np.zeros((len(recurrent), k))
+        for i, rclass in enumerate(recurrent):
+            ss[i, rclass] = _steady_state_ergodic(P[np.ix_(rclass, rclass)])
+        return ss
 
 
 def _fmpt_ergodic(P):
@@ -151,14 +288,15 @@ def _fmpt_ergodic(P):
     Parameters
     ----------
     P    : array
-           (k, k), an ergodic Markov transition probability matrix.
+           (k, k), an ergodic Markov transition probability matrix, or
+           (m, k, k), a stack of m of them.
 
     Returns
     -------
     M    : array
            (k, k), elements are the expected value for the number of intervals
            required for a chain starting in state i to first enter state j.
-           If i=j then this is the recurrence time.
+           If i=j then this is the recurrence time. (m, k, k) for a stack.
 
     Examples
     --------
@@ -185,20 +323,18 @@ def _fmpt_ergodic(P):
     """
 
     P = np.asarray(P)
-    k = P.shape[0]
-    A = np.zeros_like(P)
-    ss = _steady_state_ergodic(P)
-    for i in range(k):
-        A[:, i] = ss
-    A = A.transpose()
+    k = P.shape[-1]
+    ss = np.array([_steady_state_ergodic(p) for p in P.reshape(-1, k, k)])
+    ss = ss.reshape(P.shape[:-1])[..., None, :]
+    # every row of the limiting matrix A is the steady state
+    A = np.broadcast_to(ss, P.shape)
     I = np.identity(k)
-    Z = la.inv(I - P + A)
-    E = np.ones_like(Z)
-    A_diag = np.diag(A)
-    A_diag = A_diag + (A_diag == 0)
-    D = np.diag(1.0 / A_diag)
-    Zdg = np.diag(np.diag(Z))
-    M = (I - Z + E.dot(Zdg)).dot(D)
+    # fundamental matrix, solved for all matrices of a stack at once
+    Z = la.solve(I - P + A, np.broadcast_to(I, P.shape))
+    A_diag = ss + (ss == 0)
+    # (I - Z + E Zdg) D, where E Zdg repeats diag(Z) in every row and
+    # right-multiplying by the diagonal D scales the columns
+    M = (I - Z + np.diagonal(Z, axis1=-2, axis2=-1)[..., None, :]) / A_diag
     return M
 
 
@@ -211,7 +347,7 @@ def fmpt(P, fill_empty_classes=False):
     ----------
     P        : array
                (k, k), an ergodic/non-ergodic Markov transition probability
-               matrix.
+               matrix, or (m, k, k), a stack of m of them.
     fill_empty_classes: bool, optional
                         If True, assign 1 to diagonal elements which fall in rows full
                         of 0s to ensure the transition probability matrix is a
@@ -223,6 +359,7 @@ def fmpt(P, fill_empty_classes=False):
                (k, k), elements are the expected value for the number of
                intervals required for a chain starting in state i to first
                enter state j. If i=j then this is the recurrence time.
+               (m, k, k) for a stack of matrices.
 
     Examples
     --------
@@ -271,62 +408,105 @@ def fmpt(P, fill_empty_classes=False):
     ValueError: Input transition probability matrix has 1 rows full of 0s. Please set fill_empty_classes=True to set diagonal elements for these rows to be 1 to make sure the matrix is stochastic.
     """
 
-    P = np.asarray(P)
-    rows0 = (P.sum(axis=1) == 0).sum()
-    if rows0 > 0:
-        if fill_empty_classes:
-            P = fill_empty_diagonals(P)
-        else:
-            raise ValueError(
-                "Input transition probability matrix has "
-                "%d rows full of 0s. Please set "
-                "fill_empty_classes=True to set diagonal "
-                "elements for these rows to be 1 to make "
-                "sure the matrix is stochastic." % rows0
-            )
-    mc = qe.MarkovChain(P)
-    num_classes = mc.num_communication_classes
-    if num_classes == 1:
+    P = np.ascontiguousarray(P, dtype=np.float64)
+    P = _fill_empty_classes(P, fill_empty_classes)
+    if P.ndim == 3:
+        # the ergodic matrices of a stack are solved in one batch
+        ergodic = np.array(
+            [len(_communication_classes(p)[0]) == 1 for p in P], dtype=bool
+        )
+        fmpt_all = np.empty(P.shape)
+        if ergodic.any():
+            fmpt_all[ergodic] = _fmpt_ergodic(P[ergodic])
+        for i in np.flatnonzero(~ergodic):
+            fmpt_all[i] = fmpt(P[i])
+        return fmpt_all
+    if (np.diag(P) == 1).all():
+        # every state is absorbing: it recurs after one step and no other
+        # state can be reached from it
+        fmpt_all = np.full(P.shape, np.inf)
+        np.fill_diagonal(fmpt_all, 1.0)
+        return fmpt_all
+    classes, _ = _communication_classes(P)
+    if len(classes) == 1:
         fmpt_all = _fmpt_ergodic(P)
     else:  # deal with non-ergodic Markov chains
         k = P.shape[0]
-        fmpt_all = np.zeros((k, k))
-        for desti in range(k):
-            b = np.ones(k - 1)
-            p_sub = np.delete(np.delete(P, desti, 0), desti, 1)
-            p_calc = np.eye(k - 1) - p_sub
-            m = np.full(k - 1, np.inf)
-            row0 = (p_calc != 0).sum(axis=1)
-            none0 = np.arange(k - 1)
+        # for destination j, others[j] are the remaining states, and the
+        # passage times to j solve (I - P without row and column j) m = 1
+        others = np.nonzero(~np.eye(k, dtype=bool))[1].reshape(k, k - 1)
+        # the systems of all destinations are solved together when they fit
+        # in _FMPT_BATCH_BYTES, and one destination at a time otherwise
+        batch = k if 8 * k * (k - 1) ** 2 <= _FMPT_BATCH_BYTES else 1
+        m = np.empty((k, k - 1))
+        for start in range(0, k, batch):
+            rows = others[start : start + batch]
+            p_calc = np.eye(k - 1) - P[rows[:, :, None], rows[:, None, :]]
             try:
-                m[none0] = np.linalg.solve(p_calc, b)
-            except np.linalg.LinAlgError as err:
-                if "Singular matrix" in str(err):
-                    if (row0 == 0).sum() > 0:
-                        index0 = set(np.argwhere(row0 == 0).flatten())
-                        x = (p_calc[:, list(index0)] != 0).sum(axis=1)
-                        setx = set(np.argwhere(x).flatten())
-                        while not setx.issubset(index0):
-                            index0 = index0.union(setx)
-                            x = (p_calc[:, list(index0)] != 0).sum(axis=1)
-                            setx = set(np.argwhere(x).flatten())
-                        none0 = np.asarray(list(set(none0).difference(index0)))
-                        if len(none0) >= 1:
-                            p_calc = p_calc[none0, :][:, none0]
-                            b = b[none0]
-                            m[none0] = np.linalg.solve(p_calc, b)
-            recc = (
-                np.nan_to_num(
-                    (np.delete(P, desti, 1)[desti] * m), 0, posinf=np.inf
-                ).sum()
-                + 1
-            )
-            fmpt_all[:, desti] = np.insert(m, desti, recc)
-            fmpt_all = np.where(fmpt_all < -1e16, np.inf, fmpt_all)
-            fmpt_all = np.where(fmpt_all > 1e16, np.inf, fmpt_all)
+                m_batch = la.solve(p_calc, np.ones((len(rows), k - 1, 1)))[..., 0]
+            except la.LinAlgError:
+                # a single system that failed is known to be singular
+                singular = len(rows) == 1
+                m_batch = [_fmpt_singular(p, singular) for p in p_calc]
+            m[start : start + batch] = m_batch
+        # recurrence time: one step plus the passage time from where it lands
+        steps = P[np.arange(k)[:, None], others] * m
+        recc = np.nan_to_num(steps, 0, posinf=np.inf).sum(axis=1) + 1
+        fmpt_all = np.empty((k, k))
+        fmpt_all[others, np.arange(k)[:, None]] = m
+        fmpt_all[np.diag_indices(k)] = recc
+        fmpt_all[np.abs(fmpt_all) > 1e16] = np.inf
     return fmpt_all
 
 
+def _fmpt_singular(p_calc, singular=False):
+    """
+    First mean passage times to one destination of a non-ergodic chain
+    whose linear system may be singular.
+
+    Parameters
+    ----------
+    p_calc   : array
+               (k-1, k-1), identity minus the transition probability matrix
+               without the row and column of the destination.
+    singular : bool, optional
+               If True the system is known to be singular, and solving it as
+               a whole is not attempted. Default is False.
+
+    Returns
+    -------
+    m        : array
+               (k-1, ), first mean passage times from the other states to the
+               destination, inf for states that cannot reach it.
+
+    """
+
+    k1 = p_calc.shape[0]
+    m = np.full(k1, np.inf)
+    if not singular:
+        try:
+            m[:] = np.linalg.solve(p_calc, np.ones(k1))
+            return m
+        except np.linalg.LinAlgError as err:
+            if "Singular matrix" not in str(err):
+                return m
+    nonzero = p_calc != 0
+    # states with empty rows, and then every state that can reach
+    # one of them, never get to the destination
+    reach = ~nonzero.any(axis=1)
+    if reach.any():
+        while True:
+            new = reach | nonzero[:, reach].any(axis=1)
+            if (new == reach).all():
+                break
+            reach = new
+        none0 = np.flatnonzero(~reach)
+        if len(none0) >= 1:
+            p_calc = p_calc[np.ix_(none0, none0)]
+            m[none0] = np.linalg.solve(p_calc, np.ones(len(none0)))
+    return m
+
+
 def var_fmpt_ergodic(P):
     """
     Variances of first mean passage times for an ergodic transition
@@ -361,17 +541,16 @@ def var_fmpt_ergodic(P):
 
     """
 
-    P = np.asarray(P)
+    P = np.ascontiguousarray(P, dtype=np.float64)
     k = P.shape[0]
-    A = _steady_state_ergodic(P)
-    A = np.tile(A, (k, 1))
+    ss = _steady_state_ergodic(P)
+    A = np.broadcast_to(ss, (k, k))
     I = np.identity(k)
-    Z = la.inv(I - P + A)
-    E = np.ones_like(Z)
-    D = np.diag(1.0 / np.diag(A))
-    Zdg = np.diag(np.diag(Z))
-    M = (I - Z + E.dot(Zdg)).dot(D)
+    Z = la.solve(I - P + A, I)
+    # E Zdg and E ZMdg repeat the diagonals of Z and ZM in every row, and
+    # right-multiplying by the diagonal D (or Zdg D) scales the columns
+    Zdg = np.diag(Z)
+    M = (I - Z + Zdg) / ss
     ZM = Z.dot(M)
-    ZMdg = np.diag(np.diag(ZM))
-    W = M.dot(2 * Zdg.dot(D) - I) + 2 * (ZM - E.dot(ZMdg))
-    return np.array(W - np.multiply(M, M))
+    W = M * (2 * Zdg / ss - 1) + 2 * (ZM - np.diag(ZM))
+    return W - M * M
@@ -15,18 +15,17 @@ __all__ = [
     "GeoRank_Markov",
 ]
 
+import warnings
 import numpy as np
-from .ergodic import steady_state, fmpt
+from .ergodic import steady_state, fmpt, _communication_classes
 from .util import fill_empty_diagonals
-from .components import Graph
 from scipy import stats
 from scipy.stats import rankdata
-from operator import gt
-from libpysal import weights
-from esda.moran import Moran_Local
-import mapclassify as mc
 import itertools
-import quantecon as qe
+
+# from this many class ids on, transitions are counted by a compiled kernel
+# when numba is installed
+_NUMBA_MIN_SIZE = 2 ** 20
 
 # TT predefine LISA transitions
 # TT[i,j] is the transition type from i to j
@@ -34,11 +33,14 @@ import quantecon as qe
 # j = quadrant in period 1
 # uses one offset so first row and col of TT are ignored
 TT = np.zeros((5, 5), int)
-c = 1
-for i in range(1, 5):
-    for j in range(1, 5):
-        TT[i, j] = c
-        c += 1
+TT[1:, 1:] = np.arange(1, 17).reshape(4, 4)
+
+# MOVE_TYPES as an array indexed by the quadrants and the significance (0 or
+# 1) of the LISA end points, so that move types can be looked up for many
+# transitions at once. Each of the four significance cases shifts the
+# transition types of TT by a multiple of 16.
+_MOVE_TYPES_ARRAY = np.zeros((5, 5, 2, 2), int)
+_MOVE_TYPES_ARRAY[1:, 1:] = TT[1:, 1:, None, None] + 16 * np.array([[3, 2], [1, 0]])
 
 # MOVE_TYPES is a dictionary that returns the move type of a LISA transition
 # filtered on the significance of the LISA end points
@@ -46,19 +48,139 @@ for i in range(1, 5):
 # e.g. a key of (1, 3, True, False) indicates a significant LISA located in
 # quadrant 1 in period 0 moved to quadrant 3 in period 1 but was not
 # significant in quadrant 3.
+MOVE_TYPES = {
+    (i, j, sig_0, sig_1): int(_MOVE_TYPES_ARRAY[i, j, int(sig_0), int(sig_1)])
+    for sig_0, sig_1, i, j in itertools.product(
+        (True, False), (True, False), range(1, 5), range(1, 5)
+    )
+}
+
+
+def _class_positions(class_ids, classes):
+    """
+    Positions of class labels in an array of classes.
+
+    Parameters
+    ----------
+    class_ids : array
+                (n, t), class labels of n observations over t periods.
+    classes   : array
+                (k, ), all the class labels, not necessarily sorted.
+
+    Returns
+    -------
+    ids       : array
+                (n, t), position in classes of each label of class_ids.
+
+    """
+
+    k = len(classes)
+    order = np.argsort(classes)
+    pos = np.searchsorted(classes, class_ids, sorter=order)
+    ids = order[np.minimum(pos, k - 1)]
+    if (np.asarray(classes)[ids] != class_ids).any():
+        raise ValueError("class_ids contains values that are not in classes")
+    return ids
+
+
+def _transition_counts(ids, k, groups=None, m=1):
+    """
+    Count the transitions between classes in consecutive periods.
+
+    Parameters
+    ----------
+    ids       : array
+                (n, t), integer coded classes (0, ..., k-1) of n observations
+                over t periods.
+    k         : int
+                number of classes.
+    groups    : array, optional
+                (n, t-1), integer coded groups (0, ..., m-1) the transitions
+                are conditioned on, e.g. the spatial lag class at the start
+                of each transition. Default is None, which counts all
+                transitions together.
+    m         : int, optional
+                number of groups. Only used if groups is given.
+
+    Returns
+    -------
+    transitions : array
+                  (k, k), count of transitions from each class (rows) to
+                  each class (columns), or (m, k, k) with one such matrix
+                  per group if groups is given.
+
+    """
+
+    if ids.size >= _NUMBA_MIN_SIZE:
+        try:
+            from ._markov_numba import _transition_counts_numba
+        except ImportError:
+            pass
+        else:
+            transitions = _transition_counts_numba(ids, groups, k, m)
+            return transitions[0] if groups is None else transitions
+    keys = ids[:, :-1] * k + ids[:, 1:]
+    if groups is None:
+        transitions = np.bincount(keys.ravel(), minlength=k * k).reshape(k, k)
+    else:
+        keys = keys + groups * (k * k)
+        transitions = np.bincount(keys.ravel(), minlength=m * k * k)
+        transitions = transitions.reshape(m, k, k)
+    return transitions.astype(float)
 
-MOVE_TYPES = {}
-c = 1
-cases = (True, False)
-sig_keys = [(i, j) for i in cases for j in cases]
 
-for i, sig_key in enumerate(sig_keys):
-    c = 1 + i * 16
-    for i in range(1, 5):
-        for j in range(1, 5):
-            key = (i, j, sig_key[0], sig_key[1])
-            MOVE_TYPES[key] = c
-            c += 1
+def _column_quantile_classes(y, k):
+    """
+    Classify each column of y into its own quantiles.
+
+    Equivalent to classifying every column with mapclassify.Quantiles, but
+    the quantiles of all columns are interpolated at once.
+
+    Parameters
+    ----------
+    y         : array
+                (n, t), values to classify, one column per period.
+    k         : int
+                number of quantiles.
+
+    Returns
+    -------
+    yb        : array
+                (n, t), quantile (0, ..., k-1) each value falls in. Columns
+                with too many ties to form k distinct quantiles have fewer
+                classes.
+
+    """
+
+    n, cols = y.shape
+    w = 100.0 / k
+    p = np.arange(w, 100 + w, w)
+    if p[-1] > 100.0:
+        p[-1] = 100.0
+    # linear interpolation between order statistics, as in
+    # scipy.stats.scoreatpercentile
+    idx = p / 100.0 * (n - 1)
+    lo = np.floor(idx).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    frac = (idx - lo)[:, None]
+    ys = np.sort(y, axis=0)
+    bins = ys[lo] * (1 - frac) + ys[hi] * frac
+    # exact order statistics are not interpolated
+    exact = idx == lo
+    bins[exact] = ys[lo[exact]]
+    yb = np.empty(y.shape, int)
+    for j in range(cols):
+        col_bins = np.unique(bins[:, j])
+        if len(col_bins) < k:
+            warnings.warn(
+                "Not enough unique values in array to form %d classes. "
+                "Setting k to %d." % (k, len(col_bins)),
+                UserWarning,
+                stacklevel=2,
+            )
+        # class i holds the values in (bins[i-1], bins[i]]
+        yb[:, j] = np.searchsorted(col_bins, y[:, j], side="left")
+    return yb
 
 
 class Markov(object):
@@ -207,51 +329,42 @@ class Markov(object):
         n, t = class_ids.shape
         k = len(self.classes)
         self.k = k
-        js = list(range(t - 1))
-
-        classIds = self.classes.tolist()
-        transitions = np.zeros((k, k))
-        for state_0 in js:
-            state_1 = state_0 + 1
-            state_0 = class_ids[:, state_0]
-            state_1 = class_ids[:, state_1]
-            initial = np.unique(state_0)
-            for i in initial:
-                ending = state_1[state_0 == i]
-                uending = np.unique(ending)
-                row = classIds.index(i)
-                for j in uending:
-                    col = classIds.index(j)
-                    transitions[row, col] += sum(ending == j)
+
+        ids = _class_positions(class_ids, self.classes)
+        transitions = _transition_counts(ids, k)
         self.transitions = transitions
         row_sum = transitions.sum(axis=1)
-        self.p = np.dot(np.diag(1 / (row_sum + (row_sum == 0))), transitions)
-
-        if fill_empty_classes:
-            self.p = fill_empty_diagonals(self.p)
+        zero_rows = np.flatnonzero(row_sum == 0)
+        # counts are whole numbers, so clamping at 1 only changes empty rows
+        self.p = transitions * (1 / np.maximum(row_sum, 1, out=row_sum))[:, None]
 
+        # the class structure is found on p with its empty rows filled,
+        # whether or not self.p is filled
         p_temp = self.p
-        if (p_temp.sum(axis=1) == 0).sum() > 0:
-            p_temp = fill_empty_diagonals(p_temp)
-        markovchain = qe.MarkovChain(p_temp)
-        self.num_cclasses = markovchain.num_communication_classes
-        self.num_rclasses = markovchain.num_recurrent_classes
-
-        self.cclasses_indices = markovchain.communication_classes_indices
-        self.rclasses_indices = markovchain.recurrent_classes_indices
-        transient = set(list(map(tuple, self.cclasses_indices))).difference(
-            set(list(map(tuple, self.rclasses_indices)))
-        )
+        if zero_rows.size:
+            p_temp = fill_empty_diagonals(p_temp, zero_rows)
+        if fill_empty_classes:
+            self.p = p_temp
+        cclasses, rclasses = _communication_classes(p_temp)
+        self.num_cclasses = len(cclasses)
+        self.num_rclasses = len(rclasses)
+
+        # copies, as the classes are cached by _communication_classes
+        self.cclasses_indices = [c.copy() for c in cclasses]
+        self.rclasses_indices = [c.copy() for c in rclasses]
+        # classes are disjoint, so each is identified by its first state
+        recurrent_first = {c[0] for c in rclasses}
+        transient = [c for c in cclasses if c[0] not in recurrent_first]
         self.num_tclasses = len(transient)
         if len(transient):
-            self.tclasses_indices = [np.asarray(i) for i in transient]
+            self.tclasses_indices = [c.copy() for c in transient]
         else:
             self.tclasses_indices = None
-        self.astates_indices = list(np.argwhere(np.diag(p_temp) == 1))
+        self.astates_indices = np.flatnonzero(np.diag(p_temp) == 1).tolist()
         self.num_astates = len(self.astates_indices)
 
         if summary:
-            if markovchain.is_irreducible:
+            if self.num_cclasses == 1:
                 print("The Markov Chain is irreducible and is composed by:")
             else:
                 print("The Markov Chain is reducible and is composed by:")
@@ -279,7 +392,7 @@ class Markov(object):
                             self.num_astates
                         )
                     )
-                print(*self.astates_indices, sep=", ")
+                print(*("[%d]" % i for i in self.astates_indices), sep=", ")
 
     @property
     def fmpt(self):
@@ -351,6 +464,10 @@ class Spatial_Markov(object):
                         probability matrix is a stochastic matrix (each row
                         sums up to 1). In other words, the probability of
                         staying at that state is 1.
+    n_jobs          : int, optional
+                      number of parallel jobs the permutations are split
+                      across. -1 uses all available cores. Requires joblib
+                      when not 1. Default is 1.
 
     Attributes
     ----------
@@ -786,6 +903,7 @@ class Spatial_Markov(object):
         lag_cutoffs=None,
         variable_name=None,
         fill_empty_classes=False,
+        n_jobs=1,
     ):
 
         y = np.asarray(y)
@@ -797,16 +915,12 @@ class Spatial_Markov(object):
         self.variable_name = variable_name
 
         if discrete:
-            merged = list(itertools.chain.from_iterable(y))
-            classes = np.unique(merged)
+            classes = np.unique(y)
             self.classes = classes
             self.k = len(classes)
             self.m = self.k
-            label_dict = dict(zip(classes, range(self.k)))
-            y_int = []
-            for yi in y:
-                y_int.append(list(map(label_dict.get, yi)))
-            self.class_ids = np.array(y_int)
+            # np.unique sorts the classes, so their positions can be searched
+            self.class_ids = np.searchsorted(classes, y)
             self.lclass_ids = self.class_ids
         else:
             self.class_ids, self.cutoffs, self.k = self._maybe_classify(
@@ -822,16 +936,8 @@ class Spatial_Markov(object):
         self.T, self.P = self._calc(y, w, fill_empty_classes=fill_empty_classes)
 
         if permutations:
-            nrp = np.random.permutation
-            counter = 0
-            x2_realizations = np.zeros((permutations, 1))
-            for perm in range(permutations):
-                T, P = self._calc(nrp(y), w)
-                x2 = [chi2(T[i], self.transitions)[0] for i in range(self.k)]
-                x2s = sum(x2)
-                x2_realizations[perm] = x2s
-                if x2s >= self.x2:
-                    counter += 1
+            x2_realizations = self._draw_x2(y, w, permutations, n_jobs)[:, None]
+            counter = (x2_realizations >= self.x2).sum()
             self.x2_rpvalue = (counter + 1.0) / (permutations + 1.0)
             self.x2_realizations = x2_realizations
 
@@ -860,10 +966,7 @@ class Spatial_Markov(object):
     @property
     def F(self):
         if not hasattr(self, "_F"):
-            F = np.zeros_like(self.P)
-            for i, p in enumerate(self.P):
-                F[i] = fmpt(np.asarray(p))
-            self._F = np.asarray(F)
+            self._F = fmpt(np.asarray(self.P))
         return self._F
 
     # bickenbach and bode tests
@@ -881,22 +984,26 @@ class Spatial_Markov(object):
 
     @property
     def Q_p_value(self):
-        self._Q_p_value = self.ht.Q_p_value
+        if not hasattr(self, "_Q_p_value"):
+            self._Q_p_value = self.ht.Q_p_value
         return self._Q_p_value
 
     @property
     def LR(self):
-        self._LR = self.ht.LR
+        if not hasattr(self, "_LR"):
+            self._LR = self.ht.LR
         return self._LR
 
     @property
     def LR_p_value(self):
-        self._LR_p_value = self.ht.LR_p_value
+        if not hasattr(self, "_LR_p_value"):
+            self._LR_p_value = self.ht.LR_p_value
         return self._LR_p_value
 
     @property
     def dof_hom(self):
-        self._dof_hom = self.ht.dof
+        if not hasattr(self, "_dof_hom"):
+            self._dof_hom = self.ht.dof
         return self._dof_hom
 
     # shtests
@@ -915,13 +1022,13 @@ class Spatial_Markov(object):
     @property
     def x2(self):
         if not hasattr(self, "_x2"):
-            self._x2 = sum([c[0] for c in self.chi2])
+            self._x2 = _chi2_stack(self.T, self.transitions).sum()
         return self._x2
 
     @property
     def x2_pvalue(self):
         if not hasattr(self, "_x2_pvalue"):
-            self._x2_pvalue = 1 - stats.chi2.cdf(self.x2, self.x2_dof)
+            self._x2_pvalue = stats.chi2.sf(self.x2, self.x2_dof)
         return self._x2_pvalue
 
     @property
@@ -941,34 +1048,97 @@ class Spatial_Markov(object):
 
         """
         if self.discrete:
-            self.lclass_ids = weights.lag_categorical(w, self.class_ids, ties="tryself")
+            self.lclass_ids = self._lag_classes(y, w)[0]
         else:
-            ly = weights.lag_spatial(w, y)
-            self.lclass_ids, self.lag_cutoffs, self.m = self._maybe_classify(
-                ly, self.m, self.lag_cutoffs
-            )
+            self.lclass_ids, self.lag_cutoffs, self.m = self._lag_classes(y, w)
             self.lclasses = np.arange(self.m)
 
-        T = np.zeros((self.m, self.k, self.k))
-        n, t = y.shape
-        for t1 in range(t - 1):
-            t2 = t1 + 1
-            for i in range(n):
-                T[
-                    self.lclass_ids[i, t1], self.class_ids[i, t1], self.class_ids[i, t2]
-                ] += 1
-
-        P = np.zeros_like(T)
-        for i, mat in enumerate(T):
-            row_sum = mat.sum(axis=1)
-            row_sum = row_sum + (row_sum == 0)
-            p_i = np.array(np.diag(1.0 / row_sum)).dot(np.array(mat))
-            P[i] = p_i
+        # transitions conditional on the lag class at the start of each period
+        T = _transition_counts(
+            self.class_ids, self.k, groups=self.lclass_ids[:, :-1], m=self.m
+        )
+
+        row_sum = T.sum(axis=2, keepdims=True)
+        # counts are whole numbers, so clamping at 1 only changes empty rows
+        P = T * (1.0 / np.maximum(row_sum, 1, out=row_sum))
 
         if fill_empty_classes:
             P = fill_empty_diagonals(P)
         return T, P
 
+    def _lag_classes(self, y, w):
+        """
+        Helper to classify the spatial lags of y, see _maybe_classify.
+
+        In the discrete case the lags are the most common classes of the
+        neighbors, and only the first element of the returned tuple is
+        meaningful.
+        """
+        from libpysal import weights
+
+        if self.discrete:
+            lclass_ids = weights.lag_categorical(w, self.class_ids, ties="tryself")
+            return lclass_ids, self.lag_cutoffs, self.m
+        ly = weights.lag_spatial(w, y)
+        return self._maybe_classify(ly, self.m, self.lag_cutoffs)
+
+    def _x2_permutations(self, y, w, permutations, rng):
+        """
+        Helper to calculate the homogeneity chi-squared statistic for random
+        permutations of the rows of y.
+
+        Parameters
+        ----------
+        y            : array
+                       (n, t), variable the spatial lags are formed from.
+        w            : W
+                       spatial weights object.
+        permutations : int
+                       number of random permutations.
+        rng          : numpy.random.Generator or module
+                       source of the permutations, e.g. np.random.
+
+        Returns
+        -------
+        x2           : array
+                       (permutations, ), chi-squared statistic of each
+                       permutation.
+        """
+        x2 = np.zeros(permutations)
+        for perm in range(permutations):
+            lclass_ids, _, m = self._lag_classes(rng.permutation(y), w)
+            T = _transition_counts(
+                self.class_ids, self.k, groups=lclass_ids[:, :-1], m=m
+            )
+            x2[perm] = _chi2_stack(T, self.transitions).sum()
+        return x2
+
+    def _draw_x2(self, y, w, permutations, n_jobs):
+        """
+        Helper to calculate the homogeneity chi-squared statistic for random
+        permutations, optionally split across parallel jobs.
+
+        With n_jobs=1 the permutations are drawn from numpy's global random
+        state, so np.random.seed makes the results reproducible. Otherwise
+        each job draws from its own generator, seeded from the global state.
+        """
+        if n_jobs == 1:
+            return self._x2_permutations(y, w, permutations, np.random)
+        try:
+            from joblib import Parallel, delayed, effective_n_jobs
+        except ImportError:
+            raise ImportError("joblib is required to run permutations with n_jobs != 1")
+        n_jobs = effective_n_jobs(n_jobs)
+        sizes = [len(b) for b in np.array_split(range(permutations), n_jobs)]
+        entropy = np.random.randint(np.iinfo(np.int32).max)
+        seeds = np.random.SeedSequence(entropy).spawn(n_jobs)
+        # the permutations hold the GIL, so they run in worker processes
+        batches = Parallel(n_jobs=n_jobs)(
+            delayed(self._x2_permutations)(y, w, size, np.random.default_rng(seed))
+            for seed, size in zip(seeds, sizes)
+        )
+        return np.concatenate(batches)
+
     def _mn_test(self):
         """
         helper to calculate tests of differences between steady state
@@ -1005,7 +1175,7 @@ class Spatial_Markov(object):
         d = np.multiply((o - e), (o - e))
         d = d / e
         chi2 = d.sum()
-        pvalue = 1 - stats.chi2.cdf(chi2, self.k - 1)
+        pvalue = stats.chi2.sf(chi2, self.k - 1)
         return (chi2, pvalue, self.k - 1)
 
     def _chi2_test(self):
@@ -1013,10 +1183,12 @@ class Spatial_Markov(object):
         helper to calculate tests of differences between the conditional
         transition matrices and the overall transitions matrix.
         """
-        n0, n1, n2 = self.T.shape
-        rn = list(range(n0))
-        mat = [chi2(self.T[i], self.transitions) for i in rn]
-        return mat
+        chi2s = _chi2_stack(self.T, self.transitions)
+        dof1 = (self.T.sum(axis=2) > 0).sum(axis=1)
+        dof2 = (self.transitions.sum(axis=1) > 0).sum()
+        dofs = (dof1 - 1) * (dof2 - 1)
+        pvalues = stats.chi2.sf(chi2s, dofs)
+        return list(zip(chi2s, pvalues, dofs))
 
     def summary(self, file_name=None):
         """
@@ -1042,24 +1214,22 @@ class Spatial_Markov(object):
         """Helper method for classifying continuous data.
 
         """
-
-        rows, cols = y.shape
         if cutoffs is None:
             if self.fixed:
+                import mapclassify as mc
+
                 mcyb = mc.Quantiles(y.flatten(), k=k)
                 yb = mcyb.yb.reshape(y.shape)
                 cutoffs = mcyb.bins
                 k = len(cutoffs)
                 return yb, cutoffs[:-1], k
             else:
-                yb = np.array(
-                    [mc.Quantiles(y[:, i], k=k).yb for i in np.arange(cols)]
-                ).transpose()
-                return yb, None, k
+                return _column_quantile_classes(y, k), None, k
         else:
-            cutoffs = list(cutoffs) + [np.inf]
-            cutoffs = np.array(cutoffs)
-            yb = mc.UserDefined(y.flatten(), np.array(cutoffs)).yb.reshape(y.shape)
+            cutoffs = np.append(cutoffs, np.inf)
+            # class i holds the values in (cutoffs[i-1], cutoffs[i]], as in
+            # mapclassify.UserDefined, without its summary statistics
+            yb = np.searchsorted(cutoffs, y, side="left")
             k = len(cutoffs)
             return yb, cutoffs[:-1], k
 
@@ -1106,7 +1276,7 @@ def chi2(T1, T2):
            [  1.,  92., 815.,  51.],
            [  1.,   0.,  60., 903.]])
     >>> chi2(T1,T2)
-    (23.39728441473295, 0.005363116704861337, 9)
+    (23.39728441473295, 0.00536311670486129, 9)
 
     Notes
     -----
@@ -1122,23 +1292,87 @@ def chi2(T1, T2):
     Degrees of freedom corrected for any rows in either T1 or T2 that have
     zero total transitions.
     """
-    rs2 = T2.sum(axis=1)
-    rs1 = T1.sum(axis=1)
-    rs2nz = rs2 > 0
-    rs1nz = rs1 > 0
-    dof1 = sum(rs1nz)
-    dof2 = sum(rs2nz)
-    rs2 = rs2 + (rs2 == 0)
+    dof1 = sum(T1.sum(axis=1) > 0)
+    dof2 = sum(T2.sum(axis=1) > 0)
     dof = (dof1 - 1) * (dof2 - 1)
-    p = np.diag(1 / rs2).dot(np.array(T2))
-    E = np.diag(rs1).dot(np.array(p))
+    chi2 = _chi2_stack(T1[None], T2)[0]
+    pvalue = stats.chi2.sf(chi2, dof)
+    return chi2, pvalue, dof
+
+
+def _chi2_stack(T1, T2):
+    """
+    chi-squared statistics of the differences between a stack of transition
+    matrices and a single transition matrix.
+
+    Parameters
+    ----------
+    T1    : array
+            (m, k, k), m matrices of transitions (counts).
+    T2    : array
+            (k, k), matrix of transitions (counts) to use to form the
+            probabilities under the null.
+
+    Returns
+    -------
+          : array
+            (m, ), chi-squared statistic of each matrix in T1.
+
+    See Also
+    --------
+    chi2
+
+    """
+    T2 = np.asarray(T2)
+    rs2 = T2.sum(axis=1)
+    p = T2 * (1 / (rs2 + (rs2 == 0)))[:, None]
+    E = p * T1.sum(axis=2, keepdims=True)
     num = T1 - E
     num = np.multiply(num, num)
     E = E + (E == 0)
-    chi2 = num / E
-    chi2 = chi2.sum()
-    pvalue = 1 - stats.chi2.cdf(chi2, dof)
-    return chi2, pvalue, dof
+    return (num / E).sum(axis=(1, 2))
+
+
+def _lisa_clusters(adjacency, sig, neighbors_on=False):
+    """
+    Clusters formed by significant LISAs and their neighbors in each period.
+
+    Parameters
+    ----------
+    adjacency    : sparse matrix
+                   (n, n), CSR matrix whose nonzero entries mark the neighbors
+                   of each location.
+    sig          : array
+                   (n, t), boolean, True for the locations at the core of a
+                   cluster in each period.
+    neighbors_on : bool, optional
+                   If True, neighbors of the 1st order neighbors of the core
+                   locations are included in the clusters as well.
+
+    Returns
+    -------
+    members      : array
+                   (n, t), boolean, True for the locations in any cluster of
+                   a period.
+    labels       : array
+                   (n, t), integer, locations with the same label are in the
+                   same cluster. Labels are not shared across periods.
+
+    """
+    from scipy.sparse import csgraph, diags, identity, kron
+
+    n, t = sig.shape
+    # links from the core locations (and from their neighbors) to their
+    # neighbors, with the periods as the diagonal blocks of a single graph
+    linked = sig
+    if neighbors_on:
+        linked = sig | (adjacency.T.dot(sig.astype(float)) > 0)
+    blocks = kron(identity(t, format="csr"), adjacency, format="csr")
+    links = diags(linked.ravel(order="F").astype(float)).dot(blocks)
+    links = (links + links.T).tocsr()
+    members = np.diff(links.indptr) > 0
+    labels = csgraph.connected_components(links, directed=False)[1]
+    return members.reshape((n, t), order="F"), labels.reshape((n, t), order="F")
 
 
 class LISA_Markov(Markov):
@@ -1362,55 +1596,51 @@ class LISA_Markov(Markov):
     def __init__(
         self, y, w, permutations=0, significance_level=0.05, geoda_quads=False
     ):
+        from esda.moran import Moran_Local
+        from libpysal import weights
+
         y = y.transpose()
-        pml = Moran_Local
-        gq = geoda_quads
-        ml = [pml(yi, w, permutations=permutations, geoda_quads=gq) for yi in y]
-        q = np.array([mli.q for mli in ml]).transpose()
+        # quadrants (and pseudo p-values) of the LISAs, one column per period
+        q = np.empty(y.shape[::-1], int)
+        p = np.empty(y.shape[::-1])
+        for t, yt in enumerate(y):
+            mli = Moran_Local(yt, w, permutations=permutations, geoda_quads=geoda_quads)
+            q[:, t] = mli.q
+            if permutations > 0:
+                p[:, t] = mli.p_z_sim
         classes = np.arange(1, 5)  # no guarantee all 4 quadrants are visited
         Markov.__init__(self, q, classes, summary=False)
         self.q = q
         self.w = w
-        n, k = q.shape
-        k -= 1
-        self.significance_level = significance_level
-        move_types = np.zeros((n, k), int)
-        sm = np.zeros((n, k), int)
         self.significance_level = significance_level
+        # look up the type of every transition at once, from the quadrants
+        # (and significance) at the start and end of each period
+        origin = q[:, :-1]
+        dest = q[:, 1:]
+        self.move_types = TT[origin, dest]
         if permutations > 0:
-            p = np.array([mli.p_z_sim for mli in ml]).transpose()
             self.p_values = p
-            pb = p <= significance_level
-        else:
-            pb = np.zeros_like(y.T)
-        for t in range(k):
-            origin = q[:, t]
-            dest = q[:, t + 1]
-            p_origin = pb[:, t]
-            p_dest = pb[:, t + 1]
-            for r in range(n):
-                move_types[r, t] = TT[origin[r], dest[r]]
-                key = (origin[r], dest[r], p_origin[r], p_dest[r])
-                sm[r, t] = MOVE_TYPES[key]
-        if permutations > 0:
-            self.significant_moves = sm
-        self.move_types = move_types
+            pb = (p <= significance_level).astype(int)
+            self.significant_moves = _MOVE_TYPES_ARRAY[
+                origin, dest, pb[:, :-1], pb[:, 1:]
+            ]
 
         # null of own and lag moves being independent
 
         ybar = y.mean(axis=0)
         r = y / ybar
-        ylag = np.array([weights.lag_spatial(w, yt) for yt in y])
+        ylag = weights.lag_spatial(w, y.T).T
         rlag = ylag / ybar
         rc = r < 1.0
         rlagc = rlag < 1.0
         markov_y = Markov(rc, summary=False)
         markov_ylag = Markov(rlagc, summary=False)
-        A = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1], [0, 1, 0, 0]])
-
-        kp = A.dot(np.kron(markov_y.p, markov_ylag.p)).dot(A.T)
+        # reorder the (own, lag) states of the kronecker product from
+        # (HH, HL, LH, LL) to the quadrants (HH, LH, LL, HL)
+        quads = np.ix_([0, 2, 3, 1], [0, 2, 3, 1])
+        kp = np.kron(markov_y.p, markov_ylag.p)[quads]
         trans = self.transitions.sum(axis=1)
-        t1 = np.diag(trans).dot(kp)
+        t1 = trans[:, None] * kp
         t2 = self.transitions
         self.chi_2 = chi2(t2, t1)
         self.expected_t = t1
@@ -1475,62 +1705,23 @@ class LISA_Markov(Markov):
         if self.permutations:
             spill_over = np.zeros((n, k - 1))
             components = np.zeros((n, k))
-            i2id = {}  # handle string keys
-            for key in list(self.w.neighbors.keys()):
-                idx = self.w.id2i[key]
-                i2id[idx] = key
             sig_lisas = (self.q == quadrant) * (
                 self.p_values <= self.significance_level
             )
-            sig_ids = [np.nonzero(sig_lisas[:, i])[0].tolist() for i in range(k)]
-
-            neighbors = self.w.neighbors
+            adjacency = self.w.sparse.tocsr(copy=True)
+            adjacency.data[:] = 1
+            members, labels = _lisa_clusters(adjacency, sig_lisas, neighbors_on)
+            # locations that joined a cluster in period t + 1 whose cluster
+            # holds members of the clusters of period t
+            in1 = members[:, :-1]
+            in2 = members[:, 1:]
+            spilled = np.zeros(labels.max() + 1, bool)
+            spilled[labels[:, 1:][in1 & in2]] = True
+            spill_over[in2 & ~in1 & spilled[labels[:, 1:]]] = 1
             for t in range(k - 1):
-                s1 = sig_ids[t]
-                s2 = sig_ids[t + 1]
-                g1 = Graph(undirected=True)
-                for i in s1:
-                    for neighbor in neighbors[i2id[i]]:
-                        g1.add_edge(i2id[i], neighbor, 1.0)
-                        if neighbors_on:
-                            for nn in neighbors[neighbor]:
-                                g1.add_edge(neighbor, nn, 1.0)
-                components1 = g1.connected_components(op=gt)
-                components1 = [list(c.nodes) for c in components1]
-                g2 = Graph(undirected=True)
-                for i in s2:
-                    for neighbor in neighbors[i2id[i]]:
-                        g2.add_edge(i2id[i], neighbor, 1.0)
-                        if neighbors_on:
-                            for nn in neighbors[neighbor]:
-                                g2.add_edge(neighbor, nn, 1.0)
-                components2 = g2.connected_components(op=gt)
-                components2 = [list(c.nodes) for c in components2]
-                c2 = []
-                c1 = []
-                for c in components2:
-                    c2.extend(c)
-                for c in components1:
-                    c1.extend(c)
-
-                new_ids = [j for j in c2 if j not in c1]
-                spill_ids = []
-                for j in new_ids:
-                    # find j's component in period 2
-                    cj = [c for c in components2 if j in c][0]
-                    # for members of j's component in period 2, check if they
-                    # belonged to any components in period 1
-                    for i in cj:
-                        if i in c1:
-                            spill_ids.append(j)
-                            break
-                for spill_id in spill_ids:
-                    id = self.w.id2i[spill_id]
-                    spill_over[id, t] = 1
-                for c, component in enumerate(components1):
-                    for i in component:
-                        ii = self.w.id2i[i]
-                        components[ii, t] = c + 1
+                in_t = members[:, t]
+                ids = np.unique(labels[in_t, t], return_inverse=True)[1]
+                components[in_t, t] = ids + 1
             results = {}
             results["components"] = components
             results["spill_over"] = spill_over
@@ -1628,7 +1819,7 @@ def kullback(F):
     results = {}
     results["Conditional homogeneity"] = chom
     results["Conditional homogeneity dof"] = cdof
-    results["Conditional homogeneity pvalue"] = 1 - stats.chi2.cdf(chom, cdof)
+    results["Conditional homogeneity pvalue"] = stats.chi2.sf(chom, cdof)
     return results
 
 
@@ -1658,6 +1849,7 @@ def prais(pmat):
     --------
     >>> import numpy as np
     >>> import libpysal
+    >>> import mapclassify as mc
     >>> from giddy.markov import Markov,prais
     >>> f = libpysal.io.open(libpysal.examples.get_path("usjoin.csv"))
     >>> pci = np.array([f.by_col[str(y)] for y in range(1929,2010)])
@@ -1811,9 +2003,9 @@ class Homogeneity_Results:
         # transition matrix
         self.dof = int(((b_i - 1) * (A_i - 1)).sum())
         self.Q = Q
-        self.Q_p_value = 1 - stats.chi2.cdf(self.Q, self.dof)
+        self.Q_p_value = stats.chi2.sf(self.Q, self.dof)
         self.LR = LR * 2.0
-        self.LR_p_value = 1 - stats.chi2.cdf(self.LR, self.dof)
+        self.LR_p_value = stats.chi2.sf(self.LR, self.dof)
         self.A = A_i
         self.A_im = A_im
         self.B = B
@@ -2082,7 +2274,6 @@ def sojourn_time(p, summary=True):
     if (p.sum(axis=1) == 0).sum() > 0:
         p = fill_empty_diagonals(p)
 
-    markovchain = qe.MarkovChain(p)
     pii = p.diagonal()
 
     if not (1 - pii).all():
@@ -46,6 +46,49 @@ class Rose_Tester(unittest.TestCase):
             self.assertAlmostEqual(exp[i], obs[i])
         self.assertEqual(list(r4.counts), [32, 5, 9, 2])
 
+        r4.permute()
+        self.assertEqual(r4.counts_perm.shape, (99, k))
+        np.testing.assert_array_equal(r4.counts_perm.sum(axis=1), 48)
+        np.testing.assert_array_almost_equal(r4.p, [0.04, 0.0, 0.02, 0.0])
+        larger = [(r4.counts_perm[:, i] >= r4.counts[i]).sum() for i in range(k)]
+        smaller = [(r4.counts_perm[:, i] <= r4.counts[i]).sum() for i in range(k)]
+        np.testing.assert_array_equal(r4.larger_perm, larger)
+        np.testing.assert_array_equal(r4.smaller_perm, smaller)
+
+        r4s = directional.Rose(self.Y, self.w, k, permutations=99, seed=1)
+        r4.permute(99, seed=1)
+        np.testing.assert_array_equal(r4s.counts_perm, r4.counts_perm)
+        np.testing.assert_array_equal(r4s.p, r4.p)
+
+        r12 = directional.Rose(self.Y, self.w, k=12)
+        self.assertEqual(len(r12.cuts), 13)
+        r12.permute(alternative="positive")
+        self.assertEqual(r12.p.shape, (12,))
+        r6 = directional.Rose(self.Y, self.w, k=6)
+        self.assertRaises(ValueError, r6.permute, alternative="negative")
+
+        r4.permute(permutations=999, sequential=True, batch=50, seed=1)
+        self.assertLess(r4.counts_perm.shape[0], 999)
+        # sectors with p = 0 are not decided by the first batch alone
+        self.assertGreater(r4.counts_perm.shape[0], 50)
+        self.assertEqual(r4.counts_perm.shape[0] % 50, 0)
+        self.assertTrue((np.abs(r4.p - 0.05) > 0.01).all())
+        counts_perm = r4.counts_perm
+        larger_perm = r4.larger_perm
+        r4.permute(permutations=counts_perm.shape[0], seed=1)
+        np.testing.assert_array_equal(r4.counts_perm, counts_perm)
+        # decided sectors stop counting before the last batch
+        self.assertTrue((larger_perm <= r4.larger_perm).all())
+        r4.permute(permutations=0, sequential=True)
+        self.assertEqual(r4.counts_perm.shape, (0, k))
+
+        r4.permute(permutations=100, n_jobs=2, seed=12345)
+        self.assertEqual(r4.counts_perm.shape, (100, k))
+        np.testing.assert_array_equal(r4.counts_perm.sum(axis=1), 48)
+        counts_perm = r4.counts_perm
+        r4.permute(permutations=100, n_jobs=2, seed=12345)
+        np.testing.assert_array_equal(r4.counts_perm, counts_perm)
+
         import matplotlib.pyplot as plt
 
         # plot
@@ -14,6 +14,13 @@ class SteadyState_Tester(unittest.TestCase):
         exp = np.array([0.4, 0.2, 0.4])
         np.testing.assert_array_almost_equal(exp, obs)
 
+        # two nearly uncoupled blocks
+        p = np.kron(np.identity(2), np.full((2, 2), 0.5))
+        p[[1, 3], [1, 3]] -= [1e-13, 2e-13]
+        p[[1, 3], [2, 0]] += [1e-13, 2e-13]
+        obs = ergodic._steady_state_ergodic(p)
+        np.testing.assert_allclose([1 / 3, 1 / 3, 1 / 6, 1 / 6], obs, rtol=1e-12)
+
     def test_steady_state(self):
         obs = ergodic.steady_state(self.p)
         exp = np.array([0.4, 0.2, 0.4])
@@ -29,6 +36,21 @@ class SteadyState_Tester(unittest.TestCase):
 
         self.assertRaises(ValueError, ergodic.steady_state, self.p3, False)
 
+        # state 1 is transient, states 0 and 2 are absorbing
+        p = np.array([[1, 0, 0], [0.2, 0.5, 0.3], [0, 0, 1]])
+        classes, recurrent = ergodic._communication_classes(p)
+        self.assertEqual(len(classes), 3)
+        self.assertEqual([list(c) for c in recurrent], [[0], [2]])
+        obs = ergodic.steady_state(p)
+        np.testing.assert_array_equal([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]], obs)
+
+        np.testing.assert_array_equal(
+            ergodic.steady_state(np.identity(3)), np.identity(3)
+        )
+        p = np.tile([0.2, 0.3, 0.1, 0.4], (4, 1))
+        np.testing.assert_array_almost_equal(ergodic.steady_state(p), p[0])
+        np.testing.assert_array_almost_equal(ergodic._steady_state_ergodic(p), p[0])
+
 
 class Fmpt_Tester(unittest.TestCase):
     def setUp(self):
@@ -78,6 +100,35 @@ class Fmpt_Tester(unittest.TestCase):
         )
         np.testing.assert_array_almost_equal(exp, obs)
 
+        obs = ergodic.fmpt(np.identity(3))
+        exp = np.where(np.identity(3) == 1, 1.0, np.inf)
+        np.testing.assert_array_equal(exp, obs)
+
+        # a stack mixing ergodic and non-ergodic matrices
+        stack = np.array([self.p, self.p2, self.p.T / self.p.sum(axis=0)[:, None]])
+        obs = ergodic.fmpt(stack)
+        exp = np.array([ergodic.fmpt(p) for p in stack])
+        np.testing.assert_array_almost_equal(exp, obs)
+        self.assertRaises(ValueError, ergodic.fmpt, np.array([self.p, self.p3]))
+
+    def test_fmpt_large(self):
+        # two closed classes, too large for their systems to be solved at once
+        rng = np.random.default_rng(0)
+        blocks = rng.random((2, 100, 100))
+        blocks /= blocks.sum(axis=2, keepdims=True)
+        p = np.zeros((200, 200))
+        p[:100, :100] = blocks[0]
+        p[100:, 100:] = blocks[1]
+        obs = ergodic.fmpt(p)
+        np.testing.assert_array_almost_equal(
+            ergodic._fmpt_ergodic(blocks[0]), obs[:100, :100]
+        )
+        np.testing.assert_array_almost_equal(
+            ergodic._fmpt_ergodic(blocks[1]), obs[100:, 100:]
+        )
+        self.assertTrue(np.isinf(obs[:100, 100:]).all())
+        self.assertTrue(np.isinf(obs[100:, :100]).all())
+
 
 class VarFmpt_Tester(unittest.TestCase):
     def setUp(self):
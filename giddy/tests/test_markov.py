@@ -11,6 +11,9 @@ from ..markov import (
     FullRank_Markov,
     sojourn_time,
     GeoRank_Markov,
+    _chi2_stack,
+    _transition_counts,
+    _column_quantile_classes,
 )
 
 RTOL = 0.00001
@@ -105,6 +108,39 @@ class test_Markov(unittest.TestCase):
         expected = np.array([np.inf, 2.14285714, 1.0, np.inf, np.inf])
         np.testing.assert_array_almost_equal(m.sojourn_time, expected)
 
+        # classes need not be sorted, and must cover every class id
+        m = Markov(q5, classes=np.arange(5)[::-1], summary=False)
+        m_sorted = Markov(q5, summary=False)
+        np.testing.assert_array_equal(m.transitions, m_sorted.transitions[::-1, ::-1])
+        self.assertRaises(ValueError, Markov, q5, classes=np.arange(4))
+
+
+class test_transition_counts(unittest.TestCase):
+    def test_numba(self):
+        try:
+            from .._markov_numba import _transition_counts_numba
+        except ImportError:
+            self.skipTest("numba is not installed")
+        rng = np.random.default_rng(0)
+        ids = rng.integers(0, 4, (30, 6))
+        groups = rng.integers(0, 3, (30, 5))
+        np.testing.assert_array_equal(
+            _transition_counts_numba(ids, groups, 4, 3),
+            _transition_counts(ids, 4, groups=groups, m=3),
+        )
+        np.testing.assert_array_equal(
+            _transition_counts_numba(ids, None, 4, 1)[0], _transition_counts(ids, 4)
+        )
+
+
+class test_column_quantile_classes(unittest.TestCase):
+    def test_column_quantile_classes(self):
+        rng = np.random.default_rng(0)
+        y = np.column_stack([rng.normal(size=40), rng.integers(0, 3, 40)])
+        obs = _column_quantile_classes(y, 4)
+        exp = np.array([mc.Quantiles(y[:, i], k=4).yb for i in range(2)]).T
+        np.testing.assert_array_equal(obs, exp)
+
 
 class test_Spatial_Markov(unittest.TestCase):
     def setUp(self):
@@ -139,6 +175,20 @@ class test_Spatial_Markov(unittest.TestCase):
         )
         np.testing.assert_array_almost_equal(F0, sm.F[0])
 
+    def test_permutations(self):
+        sm = Spatial_Markov(self.rpci, self.w, fixed=True)
+        np.random.seed(5)
+        sm_perm = Spatial_Markov(self.rpci, self.w, fixed=True, permutations=19)
+        self.assertEqual(sm_perm.x2_realizations.shape, (19, 1))
+        # the permutations leave the observed lag classes alone
+        np.testing.assert_array_equal(sm_perm.lclass_ids, sm.lclass_ids)
+        np.random.seed(5)
+        sm_1 = Spatial_Markov(self.rpci, self.w, fixed=True, permutations=19, n_jobs=2)
+        np.random.seed(5)
+        sm_2 = Spatial_Markov(self.rpci, self.w, fixed=True, permutations=19, n_jobs=2)
+        np.testing.assert_array_equal(sm_1.x2_realizations, sm_2.x2_realizations)
+        self.assertEqual(sm_1.x2_realizations.shape, (19, 1))
+
     def test_cutoff(self):
         cc = np.array([0.8, 0.9, 1, 1.2])
         sm = Spatial_Markov(self.rpci, self.w, cutoffs=cc, lag_cutoffs=cc)
@@ -304,6 +354,11 @@ class test_chi2(unittest.TestCase):
         )
         np.testing.assert_array_almost_equal(obs, np.array(sm.shtest))
 
+        # all conditional matrices at once, as in the permutation test
+        np.testing.assert_array_equal(
+            _chi2_stack(sm.T, sm.transitions), [c[0] for c in sm.chi2]
+        )
+
 
 class test_LISA_Markov(unittest.TestCase):
     def test___init__(self):
@@ -344,8 +399,18 @@ class test_LISA_Markov(unittest.TestCase):
             ]
         )
         np.testing.assert_allclose(lm_random.expected_t, expected, RTOL)
+        # the p-value is a tiny upper tail probability rather than exactly 0
         c = np.array([1058.207904, 0.0, 9.0])
-        np.testing.assert_allclose(lm_random.chi_2, c, RTOL)
+        np.testing.assert_allclose(lm_random.chi_2, c, RTOL, atol=1e-200)
+
+        r = lm_random.spillover()
+        self.assertEqual((r["components"][:, 12] > 0).sum(), 17)
+        self.assertEqual((r["components"][:, 13] > 0).sum(), 23)
+        self.assertEqual((r["spill_over"][:, 12] > 0).sum(), 6)
+        rn = lm_random.spillover(neighbors_on=True)
+        self.assertEqual((rn["components"][:, 12] > 0).sum(), 26)
+        self.assertEqual((rn["components"][:, 13] > 0).sum(), 34)
+        self.assertEqual((rn["spill_over"][:, 12] > 0).sum(), 8)
 
 
 class test_kullback(unittest.TestCase):
@@ -77,7 +77,7 @@ def get_lower(matrix):
     return lowvec
 
 
-def fill_empty_diagonals(p):
+def fill_empty_diagonals(p, zero_rows=None):
     """
     Assign 1 to diagonal elements which fall in rows full of 0s to ensure
     the transition probability matrix is a stochastic one. Currently
@@ -89,6 +89,10 @@ def fill_empty_diagonals(p):
     p        : array
                (k, k), an ergodic/non-ergodic Markov transition probability
                matrix.
+    zero_rows: array, optional
+               Indices of the rows full of 0s of a two-dimensional p, if
+               they are already known. Default is None, in which case they
+               are searched for.
 
     Returns
     -------
@@ -119,14 +123,14 @@ def fill_empty_diagonals(p):
     if len(p_temp.shape) == 3:
         return _fill_empty_diagonal_3d(p_temp)
     elif len(p_temp.shape) == 2:
-        return _fill_empty_diagonal_2d(p_temp)
+        return _fill_empty_diagonal_2d(p_temp, zero_rows)
     else:
         raise NotImplementedError(
             "Filling empty diagonals is " "only implemented for 2/3d matrices."
         )
 
 
-def _fill_empty_diagonal_2d(p):
+def _fill_empty_diagonal_2d(p, zero_rows=None):
     """
     Assign 1 to diagonal elements which fall in rows full of 0s to ensure
     the transition probability matrix is a stochastic one.
@@ -136,6 +140,8 @@ def _fill_empty_diagonal_2d(p):
     p        : array
                (k, k), an ergodic/non-ergodic Markov transition probability
                matrix.
+    zero_rows: array, optional
+               Indices of the rows full of 0s, searched for if None.
 
     Returns
     -------
@@ -146,11 +152,9 @@ def _fill_empty_diagonal_2d(p):
     """
 
     p_temp = copy.copy(p)
-    p0 = p_temp.sum(axis=1) == 0
-    if p0.sum() > 0:
-        row_zero_i = np.where(p0)
-        for row in row_zero_i:
-            p_temp[row, row] = 1
+    if zero_rows is None:
+        zero_rows = np.flatnonzero(p_temp.sum(axis=1) == 0)
+    p_temp[zero_rows, zero_rows] = 1
     return p_temp
 
 
@@ -175,11 +179,6 @@ def _fill_empty_diagonal_3d(p):
     """
 
     p_temp = copy.copy(p)
-    p0 = p_temp.sum(axis=2) == 0
-    if p0.sum() > 0:
-        rows, cols = np.where(p0)
-        row_zero_i = list(zip(rows, cols))
-        for row in row_zero_i:
-            i, j = row
-            p_temp[i, j, j] = 1
+    mats, rows = np.nonzero(p_temp.sum(axis=2) == 0)
+    p_temp[mats, rows, rows] = 1
     return p_temp